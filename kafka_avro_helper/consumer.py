@@ -1,22 +1,45 @@
 import inspect
-from asyncio import sleep
-from struct import unpack
+from collections import defaultdict
+from functools import lru_cache, partial
+from asyncio import Queue, Semaphore, Task, create_task, current_task, gather, shield, sleep
 from io import BytesIO
 import fastavro  # NOQA
 from dataclasses import dataclass, field
-from typing import Callable, Union, get_origin, get_args, Awaitable, Optional, Dict, Any
+from typing import Callable, Union, get_origin, get_args, Awaitable, Optional, Dict, Any, Sequence
 from os import environ
-from aiokafka import AIOKafkaConsumer, AIOKafkaProducer
+from time import monotonic
+from aiokafka import AIOKafkaConsumer, AIOKafkaProducer, ConsumerRebalanceListener, ConsumerRecord, TopicPartition
+from aiokafka.errors import ConsumerStoppedError, KafkaError
 from types import UnionType
 from dataclasses_avroschema import AvroModel
-from .producer import get_producer, send_message
-from .validate import to_kebab_case, get_schema
+from .producer import get_producer, send_batch, send_message
+from .validate import SchemaRegistryError, get_topic, get_schema, validate_value
+from .reader import Reader, compile_reader
 from .logger import logger
 
 
 KAFKA_CONSUMER_GROUP_ID = environ.get("KAFKA_CONSUMER_GROUP_ID", "default")
 KAFKA_BROKERS = environ.get("KAFKA_BROKERS")
-schemas = {}
+KAFKA_PREFETCH_DEPTH = int(environ.get("KAFKA_PREFETCH_DEPTH", 64))
+KAFKA_FETCH_MAX_BYTES = int(environ.get("KAFKA_FETCH_MAX_BYTES", 50 * 1024 * 1024))
+KAFKA_MAX_PARTITION_FETCH_BYTES = int(environ.get("KAFKA_MAX_PARTITION_FETCH_BYTES", 2 * 1024 * 1024))
+KAFKA_FETCH_MAX_WAIT_MS = int(environ.get("KAFKA_FETCH_MAX_WAIT_MS", 500))
+KAFKA_COMMIT_BATCH = int(environ.get("KAFKA_COMMIT_BATCH", 64))
+KAFKA_COMMIT_INTERVAL_MS = int(environ.get("KAFKA_COMMIT_INTERVAL_MS", 1000))
+KAFKA_CONCURRENCY = int(environ.get("KAFKA_CONCURRENCY", 1))
+KAFKA_ON_ERROR = environ.get("KAFKA_ON_ERROR", "dlq")
+KAFKA_DLQ_SUFFIX = environ.get("KAFKA_DLQ_SUFFIX", ".dlq")
+PROCESSED_TOPIC_HEADER = "processed_topic"
+HEADER_CACHE_SIZE = 1024
+SCHEMA_CACHE_SIZE = int(environ.get("SCHEMA_CACHE_SIZE", 1024))
+SCHEMA_RETRY_INTERVAL = float(environ.get("SCHEMA_RETRY_INTERVAL", 5))
+_compiled_readers: Dict[int, Reader] = {}
+_pending_readers: Dict[int, Task] = {}
+_failed_schemas: Dict[int, tuple[float, Exception]] = {}
+_header_values: Dict[bytes, str] = {}
+# failures of the Schema Registry or Kafka, not of the record itself, they are retried instead of dead-lettered.
+# get_schema wraps httpx errors, other errors of the callback (HTTP requests, files) are failures of the record
+RETRIABLE_ERRORS = (SchemaRegistryError, KafkaError)
 
 
 @dataclass
@@ -40,54 +63,281 @@ class MagicByteError(ValueError):
     pass
 
 
+def fastavro_reader(schema: dict, data: bytes, offset: int) -> Any:
+    """ Generic fastavro decoder, used when the schema can not be compiled.
+    BytesIO shares the buffer of bytes until it is written, seeking avoids copying the payload slice """
+    avro_data = BytesIO(data)
+    avro_data.seek(offset)
+    return fastavro.schemaless_reader(avro_data, schema)
+
+
+async def load_reader(schema_id: int) -> Reader:
+    """ Fetch and compile the schema, a failed fetch is not retried for SCHEMA_RETRY_INTERVAL seconds """
+    try:
+        try:
+            schema = await get_schema(schema_id=schema_id)
+        except Exception as e:
+            _failed_schemas[schema_id] = (monotonic() + SCHEMA_RETRY_INTERVAL, e)
+            raise
+        try:
+            reader = compile_reader(schema)
+        except Exception as e:
+            # unresolved names, too deeply nested schemas or schemas the generator does not expect
+            logger.warning(f"Schema {schema_id} not compiled, fastavro reader is used: {e}")
+            reader = partial(fastavro_reader, schema)
+        if len(_compiled_readers) >= SCHEMA_CACHE_SIZE:
+            del _compiled_readers[next(iter(_compiled_readers))]
+        _compiled_readers[schema_id] = reader
+        return reader
+    finally:
+        del _pending_readers[schema_id]
+
+
+async def get_reader(schema_id: int) -> Reader:
+    """ Get decoder compiled for the schema, the schema is fetched and compiled on first use.
+    Concurrent calls for a new schema share one Schema Registry request """
+    reader = _compiled_readers.get(schema_id)
+    if reader is not None:
+        return reader
+    failed = _failed_schemas.get(schema_id)
+    if failed is not None:
+        retry_at, e = failed
+        if monotonic() < retry_at:
+            # a new exception each time, raising the cached one would keep growing its traceback
+            raise SchemaRegistryError(f"Schema {schema_id} not available, retrying later: {e}") from e
+        del _failed_schemas[schema_id]
+    task = _pending_readers.get(schema_id)
+    if task is None:
+        task = _pending_readers[schema_id] = create_task(load_reader(schema_id=schema_id))
+    return await shield(task)
+
+
+def key_deserializer(key: Optional[bytes]) -> Union[str, bytes, None]:
+    """ Deserialize key to str, a key that is not valid UTF-8 is kept as bytes, such record is skipped later """
+    if not key:
+        return None
+    try:
+        return key.decode('utf-8')
+    except UnicodeDecodeError:
+        return key
+
+
+def headers_deserializer(headers: Sequence[tuple[str, bytes]]) -> Dict[str, str]:
+    """ Deserialize Kafka headers to dict, repeated values (trace ids, sources) are decoded once and shared """
+    decoded = {}
+    for k, v in headers:
+        value = _header_values.get(v)
+        if value is None:
+            if len(_header_values) >= HEADER_CACHE_SIZE:
+                _header_values.clear()
+            value = _header_values[v] = v.decode('utf-8')
+        decoded[k] = value
+    return decoded
+
+
 async def value_deserializer(data: Optional[bytes], annotation: AvroModel) -> Optional[AvroModel]:
     """ Deserialize Avro data to AvroModel """
-    global schemas
     if data is None:
         return None
     magic_byte = data[0]
     if magic_byte != 0:
         raise MagicByteError("Invalid magic byte, expected 0.")
-    schema_id = unpack('>I', data[1:5])[0]
-    schema = schemas.get(schema_id)
-    if schema is None:
-        schema = await get_schema(schema_id=schema_id)
-        schemas[schema_id] = schema
-    avro_data = BytesIO(data[5:])
-    decoded_message = fastavro.schemaless_reader(avro_data, schema)
+    schema_id = int.from_bytes(data[1:5], 'big')
+    reader = await get_reader(schema_id=schema_id)
+    decoded_message = reader(data, 5)
     value = annotation.parse_obj(decoded_message)
-    value.validate()
+    validate_value(value)
     return value
 
 
-async def get_consumer(topics: Optional[list[str]] = None, postfix: str = "") -> AIOKafkaConsumer:
+class PrefetchQueue(ConsumerRebalanceListener):
+    """ Records fetched ahead of processing, so fetching overlaps with the callback work.
+    After a seek or a rebalance the prefetched records are stale, they are discarded """
+
+    def __init__(self, committer: "OffsetCommitter", maxsize: int = KAFKA_PREFETCH_DEPTH):
+        self.committer = committer
+        self.queue = Queue(maxsize=maxsize)
+        self.generation = 0
+
+    async def fill(self, consumer: AIOKafkaConsumer):
+        """ Put consumer records to the queue until the consumer is stopped, None marks the end.
+        Records are fetched in batches, each batch keeps the order of records within a partition """
+        try:
+            while True:
+                batches = await consumer.getmany(timeout_ms=KAFKA_FETCH_MAX_WAIT_MS, max_records=self.queue.maxsize or None)
+                generation = self.generation
+                for tp, records in batches.items():
+                    self.committer.fetched(tp, records[0].offset)
+                    for record in records:
+                        await self.queue.put((generation, record))
+        except ConsumerStoppedError:
+            pass
+        finally:
+            await self.queue.put((self.generation, None))
+
+    async def get(self) -> Optional[ConsumerRecord]:
+        while True:
+            generation, record = await self.queue.get()
+            if record is None or generation == self.generation:
+                return record
+
+    def discard(self):
+        self.generation += 1
+        while not self.queue.empty():
+            generation, record = self.queue.get_nowait()
+            if record is None:
+                self.queue.put_nowait((generation, record))
+                break
+
+    async def on_partitions_revoked(self, revoked):
+        await self.committer.revoke(revoked)
+        self.discard()
+
+    async def on_partitions_assigned(self, assigned):
+        pass
+
+
+class OffsetCommitter:
+    """ Offsets of processed records, committed every KAFKA_COMMIT_BATCH records or KAFKA_COMMIT_INTERVAL_MS.
+    Offsets are explicit because the consumer position is ahead of processing when records are prefetched """
+
+    def __init__(self, consumer: Optional[AIOKafkaConsumer] = None):
+        self.consumer = consumer
+        self.offsets: Dict[TopicPartition, int] = {}
+        # first offset not processed yet per partition, the consumer is rewound to it after a failure
+        self.positions: Dict[TopicPartition, int] = {}
+        self.pending = 0
+        self.last_commit = monotonic()
+
+    def fetched(self, tp: TopicPartition, offset: int):
+        """ Remember where processing of the partition starts, if nothing of it was processed yet """
+        self.positions.setdefault(tp, offset)
+
+    async def add(self, record: ConsumerRecord):
+        tp = TopicPartition(record.topic, record.partition)
+        self.offsets[tp] = self.positions[tp] = record.offset + 1
+        self.pending += 1
+        if self.pending >= KAFKA_COMMIT_BATCH or (monotonic() - self.last_commit) * 1000 >= KAFKA_COMMIT_INTERVAL_MS:
+            await self.commit()
+
+    async def commit(self):
+        """ Commit pending offsets, offsets of partitions no longer assigned are dropped.
+        If the commit fails the offsets stay pending """
+        offsets, self.offsets = self.offsets, {}
+        self.pending = 0
+        self.last_commit = monotonic()
+        assignment = self.consumer.assignment()
+        offsets = {tp: offset for tp, offset in offsets.items() if tp in assignment}
+        if offsets:
+            try:
+                await self.consumer.commit(offsets)
+            except Exception:
+                # kept for the next commit, unless a newer offset of the partition is pending already
+                for tp, offset in offsets.items():
+                    self.offsets.setdefault(tp, offset)
+                raise
+
+    async def revoke(self, partitions):
+        """ Commit processed offsets before the partitions are handed over, the next owner continues from them.
+        Positions of the revoked partitions are dropped """
+        try:
+            await self.commit()
+        except Exception as e:
+            logger.warning(f"Error committing offsets of revoked partitions: {e}")
+        for tp in partitions:
+            self.positions.pop(tp, None)
+
+    def rewind(self):
+        """ Seek assigned partitions to their first unprocessed offset, so prefetched records are fetched again.
+        seek_to_committed is not enough, it does not seek partitions without a committed offset """
+        assignment = self.consumer.assignment()
+        for tp, offset in self.positions.items():
+            if tp in assignment:
+                self.consumer.seek(tp, offset)
+
+
+class RecordDispatcher:
+    """ Process up to KAFKA_CONCURRENCY records at once, records of the same partition are processed in order.
+    After a failure the following records are skipped until the dispatcher is joined """
+
+    def __init__(self, process: Callable[[ConsumerRecord], Awaitable[None]], concurrency: int = KAFKA_CONCURRENCY):
+        self.process = process
+        self.concurrency = concurrency
+        self.semaphore = Semaphore(concurrency)
+        self.tails: Dict[TopicPartition, Task] = {}
+        self.error: Optional[tuple[ConsumerRecord, Exception]] = None
+
+    async def run(self, record: ConsumerRecord, previous: Optional[Task] = None):
+        if previous is not None:
+            await previous
+        if self.error is not None:
+            return
+        try:
+            await self.process(record)
+        except Exception as e:
+            self.error = (record, e)
+
+    async def run_in_slot(self, tp: TopicPartition, record: ConsumerRecord, previous: Optional[Task]):
+        try:
+            await self.run(record, previous)
+        finally:
+            self.semaphore.release()
+            if self.tails.get(tp) is current_task():
+                del self.tails[tp]
+
+    async def submit(self, record: ConsumerRecord):
+        if self.concurrency == 1:
+            return await self.run(record)
+        await self.semaphore.acquire()
+        tp = TopicPartition(record.topic, record.partition)
+        self.tails[tp] = create_task(self.run_in_slot(tp, record, self.tails.get(tp)))
+
+    async def join(self) -> Optional[tuple[ConsumerRecord, Exception]]:
+        """ Wait for all submitted records, returns the failed record and its error """
+        if self.tails:
+            await gather(*self.tails.values())
+        error, self.error = self.error, None
+        return error
+
+
+async def get_consumer(
+        topics: Optional[list[str]] = None,
+        postfix: str = "",
+        listener: Optional[ConsumerRebalanceListener] = None
+) -> AIOKafkaConsumer:
     """ postfix is used to create a unique group_id """
     _consumer = AIOKafkaConsumer(
         bootstrap_servers=KAFKA_BROKERS or "localhost",
         enable_auto_commit=False,
         group_id=KAFKA_CONSUMER_GROUP_ID + postfix,
         auto_offset_reset='earliest',
+        fetch_max_bytes=KAFKA_FETCH_MAX_BYTES,
+        max_partition_fetch_bytes=KAFKA_MAX_PARTITION_FETCH_BYTES,
+        fetch_max_wait_ms=KAFKA_FETCH_MAX_WAIT_MS,
+        key_deserializer=key_deserializer,
     )
     if KAFKA_BROKERS is None:
         logger.warning("KAFKA_BROKERS environment variable not set, consumer not started")
         return _consumer
     await _consumer.start()
     if topics:
-        _consumer.subscribe(topics=topics)
+        _consumer.subscribe(topics=topics, listener=listener)
         logger.info(f"Consumer started, listening to topics: {topics}")
     else:
-        _consumer.subscribe(pattern=".*")
+        _consumer.subscribe(pattern=".*", listener=listener)
         logger.info("Consumer started, listening to all topics")
     return _consumer
 
 
+@lru_cache(maxsize=None)
 def extract_value_annotation(callback: Callback) -> Dict[str, AvroModel]:
-    """ Extract topic annotation from callback, example: {'topic1': AvroModel1, 'topic2': AvroModel2} """
+    """ Extract topic annotation from callback, example: {'topic1': AvroModel1, 'topic2': AvroModel2}
+    The result is cached per callback and shared between calls, it must not be modified """
     value_annotation = {}
 
     def pick_event(_annotation):
-        if issubclass(_annotation, AvroModel):
-            topic = to_kebab_case(_annotation.__name__)
+        if isinstance(_annotation, type) and AvroModel in _annotation.__mro__:
+            topic = get_topic(_annotation)
             if topic in value_annotation.keys():
                 raise Exception(f"Duplicate topic {topic}")
             value_annotation[topic] = _annotation
@@ -103,40 +353,108 @@ def extract_value_annotation(callback: Callback) -> Dict[str, AvroModel]:
     return value_annotation
 
 
+def kafka_handler(callback: Callback) -> Callback:
+    """ Decorator extracting topic annotation of the callback once, when it is defined """
+    callback._kafka_topics = extract_value_annotation(callback)  # NOQA
+    return callback
+
+
+async def process_record(record: ConsumerRecord, callback: Callback, annotation: AvroModel):
+    """ Deserialize the record, pass it to the callback and send the result, decoding errors are logged and skipped """
+    # the key is decoded by the consumer, it stays bytes only if it is not valid UTF-8
+    if isinstance(record.key, bytes):
+        logger.warning(f"Error decoding message ({record.topic} - {record.key}): key is not valid UTF-8")
+        return
+    try:
+        headers = headers_deserializer(record.headers)
+        value = await value_deserializer(data=record.value, annotation=annotation)
+    except (UnicodeDecodeError, MagicByteError) as e:
+        logger.warning(f"Error decoding message ({record.topic} - {record.key}): {e}")
+        return
+    messages = await callback(
+        value=value,
+        key=record.key,
+        headers=headers,
+        topic=record.topic,
+    )
+    topic_messages = defaultdict(list)
+    for message in messages:
+        if not isinstance(message, KafkaMessage):
+            raise Exception(f"Event {message} is not a subclass of KafkaEventBase")
+        headers = message.headers.copy()
+        headers.setdefault(PROCESSED_TOPIC_HEADER, record.topic)
+        topic_messages[message.topic].append((message.key, message.value, headers))
+    futures = []
+    for topic, batch in topic_messages.items():
+        futures.extend(await send_batch(topic=topic, messages=batch))
+    # the record is done only after all messages are delivered
+    await gather(*futures)
+
+
 async def consume_messages(callback: Callback, postfix: str = "") -> (AIOKafkaConsumer, AIOKafkaProducer):
     """ Consume messages from Kafka, process them and send the result to another topic """
-    value_annotation = extract_value_annotation(callback)
+    value_annotation = getattr(callback, "_kafka_topics", None) or extract_value_annotation(callback)
     topics = list(value_annotation.keys())
-    consumer = await get_consumer(topics=topics, postfix=postfix)
+    committer = OffsetCommitter()
+    prefetch = PrefetchQueue(committer=committer)
+    consumer = await get_consumer(topics=topics, postfix=postfix, listener=prefetch)
+    committer.consumer = consumer
     producer = await get_producer()
     if len(consumer.subscription()) == 0:
         return consumer, producer
-    async for record in consumer:
+
+    async def process(record: ConsumerRecord):
         try:
-            ValueAnotation = value_annotation[record.topic]
-            key = record.key.decode('utf-8') if record.key else None
-            value = await value_deserializer(data=record.value, annotation=ValueAnotation)
-            messages = await callback(
-                value=value,
-                key=key,
-                headers={k: v.decode('utf-8') for k, v in record.headers},
-                topic=record.topic,
-            )
-            for message in messages:
-                if not issubclass(type(message), KafkaMessage):
-                    raise Exception(f"Event {message} is not a subclass of KafkaEventBase")
-                await send_message(
-                    topic=message.topic,
-                    key=message.key,
-                    value=message.value,
-                    headers={"processed_topic": record.topic, **message.headers}
-                )
-            await consumer.commit()
-        except (UnicodeDecodeError, MagicByteError) as e:
-            logger.warning(f"Error decoding message ({record.topic} - {record.key}): {e}")
+            await process_record(record=record, callback=callback, annotation=value_annotation[record.topic])
+        except RETRIABLE_ERRORS:
+            raise
         except Exception as e:
+            if KAFKA_ON_ERROR == "rewind":
+                raise
+            logger.error(f"Error processing message ({record.topic} - {record.key}), sent to dead letter queue: {e}")
+            await send_message(
+                topic=record.topic + KAFKA_DLQ_SUFFIX,
+                key=record.key,
+                value=record.value,
+                headers={"error": str(e), PROCESSED_TOPIC_HEADER: record.topic},
+            )
+        await committer.add(record)
+
+    dispatcher = RecordDispatcher(process)
+    prefetch_task = create_task(prefetch.fill(consumer))
+    try:
+        while True:
+            if prefetch.queue.empty() or dispatcher.error is not None:
+                failed = await dispatcher.join()
+                if failed is not None:
+                    record, e = failed
+                    logger.error(f"Error processing message ({record.topic} - {record.key}): {e}")
+                    # records processed before the failed one are committed, so they are not processed again.
+                    # The commit fails too when Kafka is down, the rewind still retries from the last processed record
+                    try:
+                        await committer.commit()
+                    except Exception as e:
+                        logger.warning(f"Error committing offsets: {e}")
+                    committer.rewind()
+                    prefetch.discard()
+                    await sleep(5)
+                    continue
+                # nothing to process right now, offsets of processed records should not wait for the next batch
+                try:
+                    await committer.commit()
+                except Exception as e:
+                    logger.warning(f"Error committing offsets: {e}")
+            record = await prefetch.get()
+            if record is None:
+                break
+            await dispatcher.submit(record)
+        failed = await dispatcher.join()
+        if failed is not None:
+            record, e = failed
             logger.error(f"Error processing message ({record.topic} - {record.key}): {e}")
-            await consumer.seek_to_committed()
-            # TODO: send message to dead letter queue
-            await sleep(5)
+    except BaseException:
+        # the loop is cancelled or failed, fetching must not continue in the background
+        prefetch_task.cancel()
+        raise
+    await prefetch_task
     return consumer, producer
@@ -1,15 +1,44 @@
+from asyncio import Future
 from os import environ
-from typing import Any, Optional
+from typing import Any, Optional, Sequence, Type
 from aiokafka import AIOKafkaProducer
 from dataclasses_avroschema import AvroModel
-import struct
 from .logger import logger
+from .validate import validate_value
+
+__all__ = [
+    "get_producer",
+    "send_message",
+    "send_batch",
+    "value_serializer",
+    "key_serializer",
+    "headers_serializer",
+    "get_wire_prefix",
+]
 
 MAGIC_BYTE = 0
+MAGIC_BYTE_PREFIX = MAGIC_BYTE.to_bytes(1, "big")
 KAFKA_BROKERS = environ.get("KAFKA_BROKERS")
+KAFKA_LINGER_MS = int(environ.get("KAFKA_LINGER_MS", 10))
+KAFKA_MAX_BATCH_SIZE = int(environ.get("KAFKA_MAX_BATCH_SIZE", 256 * 1024))
+KAFKA_COMPRESSION = environ.get("KAFKA_COMPRESSION", "lz4")
 __producer__: AIOKafkaProducer = None   # NOQA
 
 
+def get_wire_prefix(model_type: Type[AvroModel]) -> bytes:
+    """ Get magic byte and schema id prepended to serialized values,
+    it is cached on the class as _wire_prefix and reset when the schema is registered """
+    prefix_bytes = model_type.__dict__.get("_wire_prefix")
+    if prefix_bytes is None:
+        metadata = model_type.get_metadata()
+        if not hasattr(metadata, "schema_id"):
+            raise Exception("Model not validated. It should be validated before sending it to Kafka")
+        schema_id = metadata.schema_id  # NOQA
+        prefix_bytes = MAGIC_BYTE_PREFIX + schema_id.to_bytes(4, "big")
+        model_type._wire_prefix = prefix_bytes  # NOQA
+    return prefix_bytes
+
+
 def value_serializer(value: Any) -> Optional[bytes]:
     """ Serialize AvroModel to bytes """
     if value is None:
@@ -17,14 +46,9 @@ def value_serializer(value: Any) -> Optional[bytes]:
     if isinstance(value, bytes):
         return value
     if isinstance(value, AvroModel):
-        value.validate()
-        serialized_data = value.serialize()
-        metadata = value.get_metadata()
-        if not hasattr(metadata, "schema_id"):
-            raise Exception("Model not validated. It should be validated before sending it to Kafka")
-        schema_id = value.get_metadata().schema_id  # NOQA
-        prefix_bytes = struct.pack(">bI", MAGIC_BYTE, schema_id)
-        return prefix_bytes + serialized_data
+        validate_value(value)
+        prefix_bytes = get_wire_prefix(type(value))
+        return prefix_bytes + value.serialize()
     raise NotImplementedError(f"Value {value} of type {type(value)} not supported")
 
 
@@ -38,14 +62,24 @@ def key_serializer(value: Any) -> Optional[bytes]:
         return str(value).encode('utf-8')
 
 
+def headers_serializer(headers: Optional[dict]) -> Optional[list[tuple[str, bytes]]]:
+    """ Serialize headers to the list of (key, bytes) pairs expected by Kafka """
+    if headers is None:
+        return None
+    return [(k, v.encode('utf-8')) for k, v in headers.items()]
+
+
 async def get_producer() -> AIOKafkaProducer:
     """ Get a Kafka producer instance, it will be created if it does not exist and started if it is not ready """
     global __producer__
-    if not __producer__:
+    if __producer__ is None:
         __producer__ = AIOKafkaProducer(
             bootstrap_servers=KAFKA_BROKERS or "localhost",
             value_serializer=value_serializer,
-            key_serializer=key_serializer
+            key_serializer=key_serializer,
+            linger_ms=KAFKA_LINGER_MS,
+            max_batch_size=KAFKA_MAX_BATCH_SIZE,
+            compression_type=None if KAFKA_COMPRESSION == "none" else KAFKA_COMPRESSION,
         )
         if KAFKA_BROKERS:
             await __producer__.start()
@@ -61,17 +95,46 @@ async def send_message(
         value: AvroModel,
         headers: dict = None,
         wait=True
-):
-    """ Send a message to a Kafka topic, optionally wait for the message to be sent. """
+) -> Optional[Future]:
+    """ Send a message to a Kafka topic, optionally wait for the message to be sent.
+    Without waiting the message is only enqueued and delivered by the producer in the background,
+    batched with other messages for up to KAFKA_LINGER_MS. The returned future is resolved when it is delivered """
     producer = await get_producer()
     if not KAFKA_BROKERS:
         logger.info(f"fake sending message to {topic} with key {key} and value {value}")
         return
-    if headers is not None:
-        b_headers = [(k, v.encode('utf-8')) for k, v in headers.items()]
-    else:
-        b_headers = None
+    b_headers = headers_serializer(headers)
     if wait:
         await producer.send_and_wait(topic, key=key, value=value, headers=b_headers)
     else:
-        await producer.send(topic, key=key, value=value, headers=b_headers)
+        return await producer.send(topic, key=key, value=value, headers=b_headers)
+
+
+async def send_batch(topic: str, messages: Sequence[tuple[Any, AvroModel, Optional[dict]]]) -> list[Future]:
+    """ Send (key, value, headers) messages to a Kafka topic packed into one batch per partition,
+    returns futures resolved when the batches are delivered """
+    producer = await get_producer()
+    if not KAFKA_BROKERS:
+        for key, value, headers in messages:
+            logger.info(f"fake sending message to {topic} with key {key} and value {value}")
+        return []
+    all_partitions = sorted(await producer.partitions_for(topic))
+    available = list(producer.client.cluster.available_partitions_for_topic(topic))
+    batches = {}
+    futures = []
+    for key, value, headers in messages:
+        # serialized before appending, the partition is chosen by key bytes like in producer.send
+        key_bytes = key_serializer(key)
+        value_bytes = value_serializer(value)
+        b_headers = headers_serializer(headers)
+        partition = producer._partitioner(key_bytes, all_partitions, available)  # NOQA
+        batch = batches.get(partition)
+        if batch is None:
+            batch = batches[partition] = producer.create_batch()
+        if batch.append(timestamp=None, key=key_bytes, value=value_bytes, headers=b_headers) is None:
+            futures.append(await producer.send_batch(batch, topic, partition=partition))
+            batch = batches[partition] = producer.create_batch()
+            batch.append(timestamp=None, key=key_bytes, value=value_bytes, headers=b_headers)
+    for partition, batch in batches.items():
+        futures.append(await producer.send_batch(batch, topic, partition=partition))
+    return futures
@@ -0,0 +1,189 @@
+from struct import Struct
+from typing import Any, Callable, Dict, Union
+from fastavro.read import LOGICAL_READERS
+
+
+Reader = Callable[[bytes, int], Any]
+Schema = Union[str, list, dict]
+PRIMITIVE_TYPES = {"null", "boolean", "int", "long", "float", "double", "bytes", "string"}
+unpack_float = Struct("<f").unpack_from
+unpack_double = Struct("<d").unpack_from
+
+
+def read_long(buf: bytes, pos: int) -> (int, int):
+    """ Read zigzag varint (Avro int and long) starting at pos, returns value and the next position """
+    b = buf[pos]
+    n = b & 0x7F
+    shift = 7
+    pos += 1
+    while b & 0x80:
+        b = buf[pos]
+        n |= (b & 0x7F) << shift
+        shift += 7
+        pos += 1
+    return (n >> 1) ^ -(n & 1), pos
+
+
+class ReaderCompiler:
+    """ Generate Python source of a decoder specialized for one writer schema """
+
+    def __init__(self):
+        self.namespace = {
+            "read_long": read_long,
+            "unpack_float": unpack_float,
+            "unpack_double": unpack_double,
+        }
+        self.functions: list[list[str]] = []
+        self.named: Dict[str, dict] = {}
+        self.record_functions: Dict[str, str] = {}
+        self.counter = 0
+
+    def name(self, prefix: str) -> str:
+        self.counter += 1
+        return f"{prefix}_{self.counter}"
+
+    def constant(self, prefix: str, value: Any) -> str:
+        name = self.name(prefix)
+        self.namespace[name] = value
+        return name
+
+    def compile(self, schema: Schema) -> Reader:
+        lines = ["def reader(buf, pos):"]
+        self.emit(schema, "value", lines, "    ", namespace="")
+        lines.append("    return value")
+        self.functions.append(lines)
+        source = "\n\n".join("\n".join(function) for function in self.functions)
+        exec(compile(source, "<avro-reader>", "exec"), self.namespace)
+        return self.namespace["reader"]
+
+    @staticmethod
+    def fullname(schema: dict, namespace: str) -> (str, str):
+        name = schema["name"]
+        if "." in name:
+            return name, name.rsplit(".", 1)[0]
+        namespace = schema.get("namespace", namespace)
+        return (f"{namespace}.{name}" if namespace else name), namespace
+
+    def resolve(self, name: str, namespace: str) -> str:
+        for candidate in (f"{namespace}.{name}", name):
+            if candidate in self.named:
+                return candidate
+        raise ValueError(f"Unknown Avro type {name}")
+
+    def emit(self, schema: Schema, target: str, lines: list[str], indent: str, namespace: str):
+        """ Append lines decoding schema into variable target and advancing pos """
+        if isinstance(schema, list):
+            return self.emit_union(schema, target, lines, indent, namespace)
+        if isinstance(schema, str):
+            if schema in PRIMITIVE_TYPES:
+                return self.emit_primitive(schema, target, lines, indent)
+            fullname = self.resolve(schema, namespace)
+            if fullname in self.record_functions:
+                lines.append(f"{indent}{target}, pos = {self.record_functions[fullname]}(buf, pos)")
+                return
+            return self.emit(self.named[fullname], target, lines, indent, namespace)
+        _type = schema["type"]
+        if _type in ("record", "error"):
+            self.emit_record(schema, target, lines, indent, namespace)
+        elif _type == "enum":
+            fullname, _ = self.fullname(schema, namespace)
+            self.named[fullname] = schema
+            symbols = self.constant("symbols", tuple(schema["symbols"]))
+            index = self.name("index")
+            lines.append(f"{indent}{index}, pos = read_long(buf, pos)")
+            lines.append(f"{indent}{target} = {symbols}[{index}]")
+        elif _type == "fixed":
+            fullname, _ = self.fullname(schema, namespace)
+            self.named[fullname] = schema
+            size = int(schema["size"])
+            lines.append(f"{indent}{target} = bytes(buf[pos:pos + {size}])")
+            lines.append(f"{indent}pos += {size}")
+        elif _type in ("array", "map"):
+            self.emit_block(schema, target, lines, indent, namespace)
+        elif isinstance(_type, (dict, list)) or _type not in PRIMITIVE_TYPES:
+            return self.emit(_type, target, lines, indent, namespace)
+        else:
+            self.emit_primitive(_type, target, lines, indent)
+        logical_type = schema.get("logicalType")
+        logical_reader = LOGICAL_READERS.get(f"{_type}-{logical_type}")
+        if logical_reader is not None:
+            reader = self.constant("logical", logical_reader)
+            writer_schema = self.constant("schema", schema)
+            lines.append(f"{indent}{target} = {reader}({target}, {writer_schema})")
+
+    @staticmethod
+    def emit_primitive(_type: str, target: str, lines: list[str], indent: str):
+        if _type == "null":
+            lines.append(f"{indent}{target} = None")
+        elif _type == "boolean":
+            lines.append(f"{indent}{target} = buf[pos] != 0")
+            lines.append(f"{indent}pos += 1")
+        elif _type in ("int", "long"):
+            lines.append(f"{indent}{target}, pos = read_long(buf, pos)")
+        elif _type == "float":
+            lines.append(f"{indent}{target} = unpack_float(buf, pos)[0]")
+            lines.append(f"{indent}pos += 4")
+        elif _type == "double":
+            lines.append(f"{indent}{target} = unpack_double(buf, pos)[0]")
+            lines.append(f"{indent}pos += 8")
+        elif _type == "bytes":
+            lines.append(f"{indent}size, pos = read_long(buf, pos)")
+            lines.append(f"{indent}{target} = bytes(buf[pos:pos + size])")
+            lines.append(f"{indent}pos += size")
+        elif _type == "string":
+            lines.append(f"{indent}size, pos = read_long(buf, pos)")
+            lines.append(f"{indent}{target} = str(buf[pos:pos + size], 'utf-8')")
+            lines.append(f"{indent}pos += size")
+
+    def emit_union(self, schema: list, target: str, lines: list[str], indent: str, namespace: str):
+        index = self.name("index")
+        lines.append(f"{indent}{index}, pos = read_long(buf, pos)")
+        for i, branch in enumerate(schema):
+            lines.append(f"{indent}{'if' if i == 0 else 'elif'} {index} == {i}:")
+            self.emit(branch, target, lines, indent + "    ", namespace)
+        lines.append(f"{indent}else:")
+        lines.append(f"{indent}    raise ValueError(f'Invalid union index {{{index}}}')")
+
+    def emit_block(self, schema: dict, target: str, lines: list[str], indent: str, namespace: str):
+        """ Arrays and maps are encoded as a series of blocks, a negative count is followed by the block size """
+        count = self.name("count")
+        item = self.name("item")
+        inner = indent + "        "
+        lines.append(f"{indent}{target} = {{}}" if schema["type"] == "map" else f"{indent}{target} = []")
+        lines.append(f"{indent}{count}, pos = read_long(buf, pos)")
+        lines.append(f"{indent}while {count}:")
+        lines.append(f"{indent}    if {count} < 0:")
+        lines.append(f"{indent}        {count} = -{count}")
+        lines.append(f"{indent}        _, pos = read_long(buf, pos)")
+        lines.append(f"{indent}    for _ in range({count}):")
+        if schema["type"] == "map":
+            key = self.name("key")
+            self.emit_primitive("string", key, lines, inner)
+            self.emit(schema["values"], item, lines, inner, namespace)
+            lines.append(f"{inner}{target}[{key}] = {item}")
+        else:
+            self.emit(schema["items"], item, lines, inner, namespace)
+            lines.append(f"{inner}{target}.append({item})")
+        lines.append(f"{indent}    {count}, pos = read_long(buf, pos)")
+
+    def emit_record(self, schema: dict, target: str, lines: list[str], indent: str, namespace: str):
+        """ Every record gets its own function, so recursive records are supported """
+        fullname, namespace = self.fullname(schema, namespace)
+        function = self.name("read_record")
+        self.named[fullname] = schema
+        self.record_functions[fullname] = function
+        body = [f"def {function}(buf, pos):"]
+        fields = []
+        for field in schema["fields"]:
+            variable = self.name("field")
+            self.emit(field["type"], variable, body, "    ", namespace)
+            fields.append(f"{field['name']!r}: {variable}")
+        body.append(f"    return {{{', '.join(fields)}}}, pos")
+        self.functions.append(body)
+        lines.append(f"{indent}{target}, pos = {function}(buf, pos)")
+
+
+def compile_reader(schema: Schema) -> Reader:
+    """ Compile a decoder for Avro writer schema, it returns the same data as fastavro.schemaless_reader
+    example: compile_reader(schema)(data, 5) decodes a message skipping the magic byte and schema id """
+    return ReaderCompiler().compile(schema)
@@ -1,13 +1,22 @@
+from functools import lru_cache
 from json import loads
 from os import environ
-from typing import Type
+from typing import Dict, Type
 import re
 from dataclasses_avroschema import AvroModel
-from httpx import AsyncClient
+from fastavro import parse_schema
+from fastavro.validation import validate
+from httpx import AsyncClient, HTTPError
 from .logger import logger
 
 
 SCHEMA_REGISTRY_URL = environ.get("SCHEMA_REGISTRY_URL")
+KAFKA_SKIP_VALIDATION = environ.get("KAFKA_SKIP_VALIDATION") == "1"
+parsed_schemas: Dict[Type[AvroModel], dict] = {}
+
+
+class SchemaRegistryError(Exception):
+    pass
 
 
 async def validate_schemas(
@@ -32,7 +41,7 @@ async def validate_avro(model_type: Type[AvroModel], schema_owner: bool):
         logger.warning("SCHEMA_REGISTRY_URL environment variable not set, schema not validated")
         return
     schema = model_type.avro_schema()
-    topic = to_kebab_case(model_type.__name__)
+    topic = get_topic(model_type)
     subject = topic + "-value"
     logger.info(f"Validating {topic} schema")
     compatibility = "/compatibility" if not schema_owner else ""
@@ -44,25 +53,43 @@ async def validate_avro(model_type: Type[AvroModel], schema_owner: bool):
         data = response.json()
         if schema_owner is True:
             model_type._metadata.schema_id = data.get("id") # NOQA
+            model_type._wire_prefix = None  # NOQA
         if schema_owner is False and data.get("is_compatible") is False:
             raise Exception(f"{topic} schema is not compatible")
         return data
 
 
+def validate_value(value: AvroModel) -> bool:
+    """ Validate AvroModel instance against its schema, raises an exception if it is not valid.
+    Same as value.validate(), but the schema is parsed once per class. Skipped if KAFKA_SKIP_VALIDATION=1 """
+    if KAFKA_SKIP_VALIDATION:
+        return True
+    model_type = type(value)
+    schema = parsed_schemas.get(model_type)
+    if schema is None:
+        schema = parse_schema(model_type.avro_schema_to_python())
+        parsed_schemas[model_type] = schema
+    return validate(value.asdict(), schema)
+
+
 async def get_schema(schema_id: int) -> dict:
-    """ Get schema by id, raises an exception if the schema is not found """
+    """ Get schema by id, raises SchemaRegistryError if the schema is not found or the registry is not available """
     if SCHEMA_REGISTRY_URL is None:
-        raise Exception("SCHEMA_REGISTRY_URL environment variable not set")
+        raise SchemaRegistryError("SCHEMA_REGISTRY_URL environment variable not set")
     url = f"{SCHEMA_REGISTRY_URL}/schemas/ids/{schema_id}"
     async with AsyncClient() as client:
-        response = await client.get(url=url)
+        try:
+            response = await client.get(url=url)
+        except HTTPError as e:
+            raise SchemaRegistryError(f"Schema {schema_id} request failed: {e}") from e
         if response.status_code != 200:
-            raise Exception(response.text)
+            raise SchemaRegistryError(response.text)
         data = response.json()
         schema_str = data.get("schema")
         return loads(schema_str)
 
 
+@lru_cache(maxsize=None)
 def to_kebab_case(name: str) -> str:
     """ Convert CamelCase to kebab-case, example: CamelCase -> camel-case """
     # Add a hyphen before transitions from lowercase letters or digits to uppercase letters,
@@ -75,3 +102,12 @@ def to_kebab_case(name: str) -> str:
 
     # Convert the entire string to lowercase.
     return kebab_case_name.lower()
+
+
+def get_topic(model_type: Type[AvroModel]) -> str:
+    """ Get topic name of the model, it is computed once and cached on the class as _kebab_topic """
+    topic = model_type.__dict__.get("_kebab_topic")
+    if topic is None:
+        topic = to_kebab_case(model_type.__name__)
+        model_type._kebab_topic = topic  # NOQA
+    return topic
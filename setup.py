@@ -9,7 +9,7 @@ setup(
     url='https://github.com/idushes/kafka-helper-package',
     packages=find_packages(),
     install_requires=[
-        'aiokafka>=0.8.1,<1.0.0',
+        'aiokafka[lz4]>=0.8.1,<1.0.0',
         'httpx>=0.23.0,<1.0.0',
         'dataclasses-avroschema>=0.63.7,<1.0.0'
     ],
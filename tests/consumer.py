@@ -2,9 +2,10 @@ import asyncio
 from kafka_avro_helper.validate import validate_schemas
 from tests.slow_qraphql_operation_detected import SlowQraphqlOperationDetected
 from tests.user_feedback import UserFeedback
-from kafka_avro_helper.consumer import consume_messages, KafkaMessage
+from kafka_avro_helper.consumer import consume_messages, kafka_handler, KafkaMessage
 
 
+@kafka_handler
 async def process_user_feedback(
         value: UserFeedback | SlowQraphqlOperationDetected,
         topic: str,
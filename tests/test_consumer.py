@@ -0,0 +1,292 @@
+import asyncio
+import json
+import unittest
+from collections import namedtuple
+from io import BytesIO
+from unittest.mock import patch
+import fastavro
+from aiokafka import TopicPartition
+from aiokafka.errors import ConsumerStoppedError, KafkaConnectionError
+from kafka_avro_helper import consumer
+from kafka_avro_helper.validate import SchemaRegistryError
+from tests.user_feedback import UserFeedback
+
+TOPIC = "user-feedback"
+SCHEMA_ID = 7
+SCHEMA = json.loads(UserFeedback.avro_schema())
+
+Record = namedtuple("Record", "topic partition offset key value headers")
+
+
+def encode(user_id: str) -> bytes:
+    data = BytesIO()
+    fastavro.schemaless_writer(data, SCHEMA, {"user_id": user_id, "text": "text", "audio": None, "archived": False})
+    return b"\x00" + SCHEMA_ID.to_bytes(4, "big") + data.getvalue()
+
+
+class FakeConsumer:
+    """ Partitions of one topic in memory, getmany returns a few records per partition from the fetch position.
+    It stops after some empty fetches, committed offsets are recorded """
+
+    def __init__(self, partitions: int = 1, records: int = 10):
+        self.records = {
+            TopicPartition(TOPIC, p): [Record(TOPIC, p, i, f"{p}-{i}", encode(f"{p}-{i}"), []) for i in range(records)]
+            for p in range(partitions)
+        }
+        self.positions = {tp: 0 for tp in self.records}
+        self.committed = {}
+        self.commit_errors = 0
+        self.idle = 0
+
+    def subscription(self):
+        return {TOPIC}
+
+    def assignment(self):
+        return set(self.records)
+
+    async def getmany(self, timeout_ms: int = 0, max_records: int = None):
+        await asyncio.sleep(0)
+        batches = {}
+        for tp, records in self.records.items():
+            batch = records[self.positions[tp]:self.positions[tp] + 3]
+            if batch:
+                batches[tp] = batch
+                self.positions[tp] += len(batch)
+        if not batches:
+            self.idle += 1
+            if self.idle > 20:
+                raise ConsumerStoppedError()
+        return batches
+
+    async def commit(self, offsets):
+        if self.commit_errors:
+            self.commit_errors -= 1
+            raise KafkaConnectionError("broker is down")
+        self.committed.update(offsets)
+
+    def seek(self, tp: TopicPartition, offset: int):
+        self.positions[tp] = offset
+
+
+async def no_sleep(seconds: float):
+    await asyncio.sleep(0)
+
+
+class ConsumeMessagesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.consumer = FakeConsumer(partitions=2)
+        self.dead_letters = []
+        self.seen = []
+
+        async def get_consumer(listener=None, **kwargs):
+            return self.consumer
+
+        async def get_producer():
+            return None
+
+        async def send_message(**kwargs):
+            self.dead_letters.append(kwargs["key"])
+
+        async def get_schema(schema_id: int) -> dict:
+            return SCHEMA
+
+        for name, value in [
+            ("get_consumer", get_consumer),
+            ("get_producer", get_producer),
+            ("send_message", send_message),
+            ("get_schema", get_schema),
+            ("sleep", no_sleep),
+        ]:
+            patcher = patch.object(consumer, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.addCleanup(consumer._compiled_readers.pop, SCHEMA_ID, None)
+
+    def consume(self, errors: dict):
+        """ Run the consumer with a callback raising errors[key] the first time the key is seen """
+        errors = dict(errors)
+
+        async def callback(value: UserFeedback, key, headers, topic):
+            self.seen.append(key)
+            if key in errors:
+                raise errors.pop(key)
+            return []
+
+        asyncio.run(consumer.consume_messages(callback))
+
+    def assertAllCommitted(self):
+        self.assertEqual(self.consumer.committed, {tp: 10 for tp in self.consumer.records})
+
+    def test_record_error_is_dead_lettered(self):
+        self.consume({"0-3": ValueError("invalid"), "1-5": OSError("missing file")})
+        self.assertEqual(self.dead_letters, ["0-3", "1-5"])
+        self.assertEqual(self.seen.count("0-3"), 1)
+        self.assertEqual(self.seen.count("1-5"), 1)
+        self.assertAllCommitted()
+
+    def test_kafka_error_is_retried(self):
+        self.consume({"0-3": KafkaConnectionError("broker is down")})
+        self.assertEqual(self.dead_letters, [])
+        self.assertEqual(self.seen.count("0-3"), 2)
+        self.assertAllCommitted()
+
+    def test_rewind_without_committed_offset(self):
+        # nothing is committed when the first record fails, the partition is rewound to offset 0 anyway
+        with patch.object(consumer, "KAFKA_ON_ERROR", "rewind"):
+            self.consume({"0-0": ValueError("invalid"), "1-4": ValueError("invalid")})
+        self.assertEqual(self.dead_letters, [])
+        for p in range(2):
+            keys = [key for key in self.seen if key.startswith(f"{p}-")]
+            self.assertEqual(sorted(set(keys), key=lambda key: int(key[2:])), [f"{p}-{i}" for i in range(10)])
+        self.assertEqual(self.seen.count("0-0"), 2)
+        self.assertEqual(self.seen.count("1-4"), 2)
+        self.assertAllCommitted()
+
+    def test_commit_error_after_failure(self):
+        self.consumer.commit_errors = 3
+        self.consume({"0-3": KafkaConnectionError("broker is down")})
+        self.assertEqual(self.seen.count("0-3"), 2)
+        self.assertAllCommitted()
+
+
+class OffsetCommitterTest(unittest.TestCase):
+
+    def test_rewind_to_first_unprocessed(self):
+        fake = FakeConsumer(partitions=2)
+        committer = consumer.OffsetCommitter(fake)
+        tp0, tp1 = TopicPartition(TOPIC, 0), TopicPartition(TOPIC, 1)
+        committer.fetched(tp0, 0)
+        committer.fetched(tp1, 4)
+        asyncio.run(committer.add(fake.records[tp0][0]))
+        asyncio.run(committer.add(fake.records[tp0][1]))
+        fake.positions = {tp0: 9, tp1: 9}
+        committer.rewind()
+        self.assertEqual(fake.positions, {tp0: 2, tp1: 4})
+
+    def test_revoke_commits_pending_offsets(self):
+        fake = FakeConsumer(partitions=2)
+        committer = consumer.OffsetCommitter(fake)
+        prefetch = consumer.PrefetchQueue(committer=committer)
+        tp0, tp1 = TopicPartition(TOPIC, 0), TopicPartition(TOPIC, 1)
+        asyncio.run(committer.add(fake.records[tp0][5]))
+        asyncio.run(committer.add(fake.records[tp1][7]))
+        asyncio.run(prefetch.on_partitions_revoked({tp0}))
+        self.assertEqual(fake.committed, {tp0: 6, tp1: 8})
+        self.assertEqual(committer.positions, {tp1: 8})
+        self.assertEqual(committer.offsets, {})
+
+    def test_failed_commit_stays_pending(self):
+        fake = FakeConsumer()
+        fake.commit_errors = 1
+        committer = consumer.OffsetCommitter(fake)
+        tp = TopicPartition(TOPIC, 0)
+        asyncio.run(committer.add(fake.records[tp][3]))
+        with self.assertRaises(KafkaConnectionError):
+            asyncio.run(committer.commit())
+        asyncio.run(committer.commit())
+        self.assertEqual(fake.committed, {tp: 4})
+
+
+class RecordDispatcherTest(unittest.TestCase):
+
+    def test_partition_order(self):
+        records = [Record(TOPIC, i % 3, i // 3, None, None, []) for i in range(30)]
+        processed = []
+        running = []
+        max_running = 0
+
+        async def process(record):
+            nonlocal max_running
+            running.append(record)
+            max_running = max(max_running, len(running))
+            await asyncio.sleep(0.001 * ((record.offset * 7 + record.partition) % 3))
+            running.remove(record)
+            processed.append(record)
+
+        async def dispatch():
+            dispatcher = consumer.RecordDispatcher(process, concurrency=4)
+            for record in records:
+                await dispatcher.submit(record)
+            return await dispatcher.join()
+
+        self.assertIsNone(asyncio.run(dispatch()))
+        self.assertGreater(max_running, 1)
+        self.assertLessEqual(max_running, 4)
+        for p in range(3):
+            self.assertEqual([r.offset for r in processed if r.partition == p], list(range(10)))
+
+    def test_failure_skips_following_records(self):
+        processed = []
+
+        async def process(record):
+            if record.offset == 2:
+                raise ValueError("invalid")
+            processed.append(record.offset)
+
+        async def dispatch():
+            dispatcher = consumer.RecordDispatcher(process, concurrency=2)
+            for offset in range(5):
+                await dispatcher.submit(Record(TOPIC, 0, offset, None, None, []))
+            return await dispatcher.join()
+
+        record, e = asyncio.run(dispatch())
+        self.assertEqual(record.offset, 2)
+        self.assertIsInstance(e, ValueError)
+        self.assertEqual(processed, [0, 1])
+
+
+class GetReaderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.calls = []
+        self.error = None
+
+        async def get_schema(schema_id: int) -> dict:
+            self.calls.append(schema_id)
+            await asyncio.sleep(0.001)
+            if self.error is not None:
+                raise self.error
+            return SCHEMA
+
+        patcher = patch.object(consumer, "get_schema", get_schema)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(consumer._compiled_readers.pop, SCHEMA_ID, None)
+        self.addCleanup(consumer._failed_schemas.pop, SCHEMA_ID, None)
+
+    def test_single_flight(self):
+        async def load():
+            return await asyncio.gather(*[consumer.get_reader(schema_id=SCHEMA_ID) for _ in range(10)])
+
+        readers = asyncio.run(load())
+        self.assertEqual(self.calls, [SCHEMA_ID])
+        self.assertEqual(len({id(reader) for reader in readers}), 1)
+        self.assertEqual(consumer._pending_readers, {})
+
+    def test_retry_window(self):
+        self.error = SchemaRegistryError("registry is down")
+        with self.assertRaises(SchemaRegistryError) as first:
+            asyncio.run(consumer.get_reader(schema_id=SCHEMA_ID))
+        errors = []
+        for _ in range(2):
+            with self.assertRaises(SchemaRegistryError) as cached:
+                asyncio.run(consumer.get_reader(schema_id=SCHEMA_ID))
+            errors.append(cached.exception)
+        self.assertEqual(self.calls, [SCHEMA_ID])
+        self.assertIsNot(errors[0], errors[1])
+        self.assertIs(errors[0].__cause__, first.exception)
+        self.assertIs(errors[1].__cause__, first.exception)
+
+    def test_retry_after_window(self):
+        self.error = SchemaRegistryError("registry is down")
+        with patch.object(consumer, "SCHEMA_RETRY_INTERVAL", 0):
+            with self.assertRaises(SchemaRegistryError):
+                asyncio.run(consumer.get_reader(schema_id=SCHEMA_ID))
+        self.error = None
+        asyncio.run(consumer.get_reader(schema_id=SCHEMA_ID))
+        self.assertEqual(self.calls, [SCHEMA_ID, SCHEMA_ID])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,178 @@
+import asyncio
+import datetime
+import decimal
+import unittest
+import uuid
+from io import BytesIO
+from functools import partial
+import fastavro
+from kafka_avro_helper import consumer
+from kafka_avro_helper.reader import compile_reader
+
+HEADER = b"\x00\x00\x00\x00\x01"
+
+NODE = {
+    "type": "record",
+    "name": "Node",
+    "fields": [
+        {"name": "value", "type": "int"},
+        {"name": "next", "type": ["null", "Node"]},
+    ],
+}
+
+SCHEMA = {
+    "type": "record",
+    "name": "Everything",
+    "namespace": "com.example",
+    "fields": [
+        {"name": "null_field", "type": "null"},
+        {"name": "boolean_field", "type": "boolean"},
+        {"name": "int_field", "type": "int"},
+        {"name": "long_field", "type": "long"},
+        {"name": "float_field", "type": "float"},
+        {"name": "double_field", "type": "double"},
+        {"name": "bytes_field", "type": "bytes"},
+        {"name": "string_field", "type": "string"},
+        {"name": "optional_field", "type": ["null", "string"]},
+        {"name": "union_field", "type": ["null", "long", "string"]},
+        {"name": "color", "type": {"type": "enum", "name": "Color", "symbols": ["RED", "GREEN", "BLUE"]}},
+        {"name": "other_color", "type": "Color"},
+        {"name": "full_name_color", "type": "com.example.Color"},
+        {"name": "hash", "type": {"type": "fixed", "name": "Hash", "size": 4}},
+        {"name": "other_hash", "type": "Hash"},
+        {"name": "matrix", "type": {"type": "array", "items": {"type": "array", "items": "int"}}},
+        {"name": "colors", "type": {"type": "map", "values": "Color"}},
+        {"name": "node", "type": NODE},
+        {"name": "timestamp", "type": {"type": "long", "logicalType": "timestamp-millis"}},
+        {"name": "date", "type": {"type": "int", "logicalType": "date"}},
+        {"name": "amount", "type": {"type": "bytes", "logicalType": "decimal", "precision": 6, "scale": 2}},
+        {"name": "id", "type": {"type": "string", "logicalType": "uuid"}},
+    ],
+}
+
+RECORD = {
+    "null_field": None,
+    "boolean_field": True,
+    "int_field": -42,
+    "long_field": 2 ** 40,
+    "float_field": 1.5,
+    "double_field": -2.25,
+    "bytes_field": b"\x00\xff",
+    "string_field": "héllo",
+    "optional_field": None,
+    "union_field": "text",
+    "color": "BLUE",
+    "other_color": "RED",
+    "full_name_color": "GREEN",
+    "hash": b"abcd",
+    "other_hash": b"wxyz",
+    "matrix": [[1, 2], [], [-3]],
+    "colors": {"a": "RED", "b": "GREEN"},
+    "node": {"value": 1, "next": {"value": 2, "next": None}},
+    "timestamp": datetime.datetime(2024, 1, 2, 3, 4, 5, 678000, tzinfo=datetime.timezone.utc),
+    "date": datetime.date(2020, 2, 29),
+    "amount": decimal.Decimal("1234.56"),
+    "id": uuid.UUID("12345678-1234-5678-1234-567812345678"),
+}
+
+
+def encode(schema, record) -> bytes:
+    data = BytesIO()
+    fastavro.schemaless_writer(data, schema, record)
+    return HEADER + data.getvalue()
+
+
+def fastavro_decode(schema, data: bytes):
+    return fastavro.schemaless_reader(BytesIO(data[5:]), schema)
+
+
+class CompileReaderTest(unittest.TestCase):
+
+    def assertSameAsFastavro(self, schema, data: bytes):
+        self.assertEqual(compile_reader(schema)(data, 5), fastavro_decode(schema, data))
+
+    def test_all_types(self):
+        data = encode(SCHEMA, RECORD)
+        self.assertEqual(compile_reader(SCHEMA)(data, 5), RECORD)
+        self.assertSameAsFastavro(SCHEMA, data)
+
+    def test_memoryview(self):
+        data = encode(SCHEMA, RECORD)
+        self.assertEqual(compile_reader(SCHEMA)(memoryview(data), 5), RECORD)
+
+    def test_primitive_top_level(self):
+        for schema, value in [("string", "text"), ("long", -1), ("double", 0.5), ("boolean", False)]:
+            self.assertSameAsFastavro(schema, encode(schema, value))
+
+    def test_union_branches(self):
+        schema = ["null", "long", "string", NODE]
+        for value in [None, 7, "seven", {"value": 7, "next": None}]:
+            self.assertSameAsFastavro(schema, encode(schema, value))
+
+    def test_invalid_union_index(self):
+        schema = ["null", "string"]
+        data = HEADER + b"\x0a"  # union index 5
+        with self.assertRaises(ValueError):
+            compile_reader(schema)(data, 5)
+        with self.assertRaises(IndexError):
+            fastavro_decode(schema, data)
+
+    def test_negative_block_count(self):
+        # two blocks, the first one with negative count followed by its size in bytes
+        array_schema = {"type": "array", "items": "int"}
+        array_data = HEADER + b"\x03\x04\x02\x04" + b"\x02\x06" + b"\x00"
+        self.assertEqual(compile_reader(array_schema)(array_data, 5), [1, 2, 3])
+        self.assertSameAsFastavro(array_schema, array_data)
+        map_schema = {"type": "map", "values": "int"}
+        map_data = HEADER + b"\x03\x0c\x02a\x02\x02b\x04" + b"\x00"
+        self.assertEqual(compile_reader(map_schema)(map_data, 5), {"a": 1, "b": 2})
+        self.assertSameAsFastavro(map_schema, map_data)
+
+    def test_recursive_record(self):
+        value = {"value": 1, "next": {"value": 2, "next": {"value": 3, "next": None}}}
+        self.assertSameAsFastavro(NODE, encode(NODE, value))
+
+
+class ReaderFallbackTest(unittest.TestCase):
+
+    @staticmethod
+    def load_reader(schema, schema_id: int):
+        async def get_schema(schema_id: int) -> dict:
+            return schema
+
+        original = consumer.get_schema
+        consumer.get_schema = get_schema
+        try:
+            return asyncio.run(consumer.get_reader(schema_id=schema_id))
+        finally:
+            consumer.get_schema = original
+            consumer._compiled_readers.pop(schema_id, None)
+
+    def assertFastavroReader(self, reader, schema):
+        self.assertIsInstance(reader, partial)
+        self.assertIs(reader.func, consumer.fastavro_reader)
+        self.assertEqual(reader.args, (schema,))
+
+    def test_unresolved_name_uses_fastavro(self):
+        schema = {"type": "record", "name": "Broken", "fields": [{"name": "value", "type": "Missing"}]}
+        self.assertFastavroReader(self.load_reader(schema, schema_id=1001), schema)
+
+    def test_nested_arrays_use_fastavro(self):
+        # the generated code has a loop per level, Python allows only 20 nested blocks
+        schema = "int"
+        value = 1
+        for _ in range(11):
+            schema = {"type": "array", "items": schema}
+            value = [value]
+        reader = self.load_reader(schema, schema_id=1002)
+        self.assertFastavroReader(reader, schema)
+        self.assertEqual(reader(encode(schema, value), 5), value)
+
+    def test_fastavro_reader_skips_header(self):
+        schema = {"type": "record", "name": "Simple", "fields": [{"name": "value", "type": "string"}]}
+        data = encode(schema, {"value": "text"})
+        self.assertEqual(consumer.fastavro_reader(schema, data, 5), {"value": "text"})
+
+
+if __name__ == '__main__':
+    unittest.main()